@@ -1,9 +1,11 @@
 import streamlit as st
-import pandas as pd
-from PIL import Image
 import io
 import os
+import csv
+import hashlib
 import threading # 引入线程锁，解决并发问题
+import sqlite3
+import uuid
 
 # --- 页面基础配置 ---
 st.set_page_config(page_title="衣服投票", layout="wide")
@@ -12,83 +14,188 @@ st.set_page_config(page_title="衣服投票", layout="wide")
 if not os.path.exists("images"):
     os.makedirs("images")
 
+# --- 图片列表 ---
+@st.cache_data(max_entries=4)
+def get_all_images(dir_mtime):
+    """
+    获取 images 文件夹下的所有图片 {文件名: {"path": 路径, "label": 勾选框文字}}（按文件名排序）
+    ⚡️ 以文件夹修改时间为缓存键，文件夹没变就不重新扫描；勾选框文字也在这里一次性生成
+    只保留最近几个版本的列表，旧的自动淘汰
+    """
+    valid_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+    with os.scandir("images") as it:
+        entries = sorted(
+            (e for e in it if e.is_file() and e.name.lower().endswith(valid_extensions)),
+            key=lambda e: e.name,
+        )
+    return {
+        e.name: {"path": e.path, "label": f"喜欢这件 (#{idx+1})"}
+        for idx, e in enumerate(entries)
+    }
+
 # --- 全局状态管理 ---
+DB_PATH = "votes.db"
+
 @st.cache_resource
 class GlobalState:
     def __init__(self):
-        self.votes = {}        # 存储票数
-        self.voters = []       # 存储已投票的人
         self.voting_open = True 
         self.lock = threading.Lock() # 🔒 核心：创建一个锁，防止数据冲突
-    
-    def get_all_images(self):
-        """获取 images 文件夹下的所有图片"""
-        valid_extensions = ('.png', '.jpg', '.jpeg', '.bmp')
-        image_files = []
         
-        # 扫描 images 文件夹
-        if os.path.exists("images"):
-            files = sorted([f for f in os.listdir("images") if f.lower().endswith(valid_extensions)])
-            for f in files:
-                image_files.append(os.path.join("images", f))
+        # 💾 票数和投票名单存到 SQLite（WAL 模式），服务重启后数据不丢
+        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS votes (name TEXT PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS voters (name TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS images (digest TEXT PRIMARY KEY, name TEXT NOT NULL)")
         
-        return image_files
-
+        # ⚡️ 总票数和参与人数在内存里随投票累加，侧边栏直接读取，无需每次扫描整张表
+        self.total_votes = self.conn.execute("SELECT COALESCE(SUM(count), 0) FROM votes").fetchone()[0]
+        self.voter_total = self.conn.execute("SELECT COUNT(*) FROM voters").fetchone()[0]
+    
     def save_uploaded_image(self, uploaded_file):
         """
         核心修复：将网页上传的图片直接保存到服务器磁盘
-        并进行压缩，防止卡顿
+        并进行压缩，防止卡顿；内容完全相同的图片只保存一次
         """
+        from PIL import Image, ImageOps # 只有上传时才用到 PIL，延迟导入加快启动
+        
         try:
-            image = Image.open(uploaded_file)
-            
-            # ⚡️ 性能优化：如果图片太大，进行压缩 (最大宽度 800px)
-            max_width = 800
-            if image.width > max_width:
-                ratio = max_width / image.width
-                new_height = int(image.height * ratio)
-                image = image.resize((max_width, new_height))
+            # 按上传内容计算哈希，已经保存过（且文件还在）就跳过
+            digest = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+            with self.lock:
+                row = self.conn.execute("SELECT name FROM images WHERE digest = ?", (digest,)).fetchone()
+                if row:
+                    if os.path.exists(os.path.join("images", row[0])):
+                        return False
+                    # 文件已被手动删除，作废旧记录，允许重新上传
+                    self.conn.execute("DELETE FROM images WHERE digest = ?", (digest,))
             
-            # 保存到 images 文件夹
-            save_path = os.path.join("images", uploaded_file.name)
+            # ⚡️ 性能优化：上传时一次性缩小到 800px 以内并重新编码，只保存小图
+            max_size = (800, 800)
+            base = os.path.splitext(uploaded_file.name)[0]
             
-            # 如果文件名重复，自动改名
-            if os.path.exists(save_path):
-                base, ext = os.path.splitext(uploaded_file.name)
-                save_path = os.path.join("images", f"{base}_new{ext}")
+            def free_path(ext):
+                # 如果文件名重复（但内容不同），加上哈希后缀改名，不会覆盖已有图片
+                save_path = os.path.join("images", f"{base}{ext}")
+                if os.path.exists(save_path):
+                    save_path = os.path.join("images", f"{base}_{digest[:8]}{ext}")
+                return save_path
             
-            # 保存文件
-            image.save(save_path, optimize=True, quality=85)
+            # 用 with 管理原图和转换后的副本，用完立即释放 PIL 解码缓冲
+            # Image.open 只读文件头，拿到尺寸和格式时还没有解码像素
+            with Image.open(uploaded_file) as src:
+                # 只有不带任何元数据的 JPEG 才能原样发布（白名单）：EXIF/XMP/IPTC 等可能含 GPS 位置、
+                # 作者、相机序列号，Pillow 不认识的 APPn 段也一样，统统走下面的重新编码
+                safe_info = {"jfif", "jfif_version", "jfif_unit", "jfif_density", "dpi",
+                             "icc_profile", "adobe", "adobe_transform", "progressive", "progression"}
+                safe_segments = {"APP0": b"JFIF\0", "APP2": b"ICC_PROFILE\0", "APP14": b"Adobe"}
+                has_metadata = not set(src.info) <= safe_info or any(
+                    marker not in safe_segments or not data.startswith(safe_segments[marker])
+                    for marker, data in getattr(src, "applist", ())
+                )
+                if (src.format == "JPEG" and not has_metadata
+                        and src.width <= max_size[0] and src.height <= max_size[1]):
+                    # 已经是小尺寸且无元数据的 JPEG：原样写入，省掉一次解码和有损的重新编码
+                    save_path = free_path(".jpg")
+                    with open(save_path, "wb") as f:
+                        f.write(uploaded_file.getvalue())
+                else:
+                    # 带透明通道的图保留 alpha，其余转成 RGB
+                    has_alpha = src.mode in ("RGBA", "LA", "PA") or "transparency" in src.info
+                    with src.convert("RGBA" if has_alpha else "RGB") as image:
+                        # 重新编码会丢掉 EXIF，先按其中的方向信息把手机照片转正
+                        ImageOps.exif_transpose(image, in_place=True)
+                        # 颜色极少的彩色图（纯色、图标类）用调色板 PNG，其余（包括黑白照片）用 WebP
+                        flat = (
+                            src.mode not in ("L", "LA", "I", "I;16")
+                            and image.getcolors(maxcolors=64) is not None
+                        )
+                        image.thumbnail(max_size, Image.Resampling.LANCZOS)
+                        save_path = free_path(".png" if flat else ".webp")
+                        
+                        # 保存到 images 文件夹
+                        if flat:
+                            # FASTOCTREE 支持 RGBA，量化后透明背景不会变黑
+                            with image.quantize(colors=64, method=Image.Quantize.FASTOCTREE) as pal:
+                                pal.save(save_path, "PNG", optimize=True)
+                        else:
+                            image.save(save_path, "WEBP", quality=80, method=6)
             
-            # 初始化票数
+            # 登记图片哈希，初始化票数
             file_name = os.path.basename(save_path)
             with self.lock: # 加锁操作
-                if file_name not in self.votes:
-                    self.votes[file_name] = 0
+                try:
+                    self.conn.execute("INSERT INTO images (digest, name) VALUES (?, ?)", (digest, file_name))
+                except sqlite3.IntegrityError:
+                    # 另一个管理员同时上传了同一张图，已经登记过了：删掉刚写的这份（同名时就是对方那份，保留）
+                    row = self.conn.execute("SELECT name FROM images WHERE digest = ?", (digest,)).fetchone()
+                    if row[0] != file_name:
+                        os.remove(save_path)
+                    return False
+                self.conn.execute("INSERT OR IGNORE INTO votes (name, count) VALUES (?, 0)", (file_name,))
+            get_all_images.clear() # 有新图片，刷新图片列表缓存
             return True
         except Exception as e:
             print(f"Error saving image: {e}")
             return False
 
     def cast_vote(self, voter_name, selected_imgs):
-        """安全投票逻辑"""
+        """安全投票逻辑：登记投票人和累加票数在同一个事务里完成"""
         with self.lock: # 🔒 加锁：确保同一时间只有一个人能修改数据
-            if voter_name in self.voters:
-                return False, "你已经投过票了！"
-            
-            for name in selected_imgs:
-                if name not in self.votes:
-                    self.votes[name] = 0
-                self.votes[name] += 1
-            
-            self.voters.append(voter_name)
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self.conn.execute("INSERT OR IGNORE INTO voters (name) VALUES (?)", (voter_name,))
+                if cur.rowcount == 0:
+                    self.conn.execute("ROLLBACK")
+                    return False, "你已经投过票了！"
+                self.conn.executemany(
+                    "INSERT INTO votes (name, count) VALUES (?, 1) "
+                    "ON CONFLICT(name) DO UPDATE SET count = count + 1",
+                    ((name,) for name in selected_imgs),
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.total_votes += len(selected_imgs)
+            self.voter_total += 1
             return True, "投票成功！"
 
-# 获取全局状态
+    def get_votes(self):
+        """读取所有图片的票数 {文件名: 票数}"""
+        with self.lock:
+            return dict(self.conn.execute("SELECT name, count FROM votes"))
+
+    def voter_names(self):
+        """已投票名单（按名字排序）"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT name FROM voters ORDER BY name")]
+
+    def reset(self, image_names):
+        """清空投票数据，并把现有图片的票数重置为 0"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM votes")
+                self.conn.execute("DELETE FROM voters")
+                self.conn.executemany("INSERT INTO votes (name, count) VALUES (?, 0)", ((n,) for n in image_names))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.total_votes = 0
+            self.voter_total = 0
+
+# 获取全局状态（票数、投票名单、投票开关：所有人共享）
 state = GlobalState()
 
+# 每个浏览器会话一个固定的用户 ID（勾选状态等：仅本人可见）
+uid = st.session_state.setdefault("uid", uuid.uuid4().hex)
+
 # 获取当前所有图片
-current_images = state.get_all_images()
+current_images = get_all_images(os.stat("images").st_mtime_ns)
 
 # --- 侧边栏：管理员面板 ---
 with st.sidebar:
@@ -101,6 +208,13 @@ with st.sidebar:
         st.subheader("📤 网页上传图片")
         st.info("原理：图片会保存到服务器临时磁盘，所有人立即可见。")
         
+        # 显示上一次发布的结果（发布成功后页面会刷新，结果暂存在 session_state 里）
+        if "upload_result" in st.session_state:
+            success_count, skipped = st.session_state.pop("upload_result")
+            st.success(f"成功发布 {success_count} 张图片！")
+            if skipped > 0:
+                st.warning(f"{skipped} 张图片重复或无法读取，已跳过")
+        
         uploaded_files = st.file_uploader(
             "上传新图片 (自动压缩)", 
             type=['png', 'jpg', 'jpeg'], 
@@ -114,38 +228,38 @@ with st.sidebar:
                     if state.save_uploaded_image(f):
                         success_count += 1
                 
+                skipped = len(uploaded_files) - success_count
                 if success_count > 0:
-                    st.success(f"成功发布 {success_count} 张图片！")
+                    st.session_state["upload_result"] = (success_count, skipped)
                     st.rerun() # 强制刷新，让新图显示出来
+                elif skipped > 0:
+                    st.warning(f"{skipped} 张图片重复或无法读取，已跳过")
 
         st.write("---")
         st.subheader("📊 投票统计")
-        total_votes = sum(state.votes.values())
         st.write(f"图片总数: {len(current_images)}")
-        st.write(f"总票数: {total_votes}")
-        st.write(f"参与人数: {len(state.voters)}")
+        st.write(f"总票数: {state.total_votes}")
+        st.write(f"参与人数: {state.voter_total}")
+        # 名单只在点击时查询（expander 折叠时内容也会执行，不适合放这里）
+        if st.button("查看已投票名单"):
+            st.write(", ".join(state.voter_names()) or "暂无")
         
         if st.button("生成 Excel 结果"):
-            data = []
-            for img_path in current_images:
-                name = os.path.basename(img_path)
-                data.append({
-                    "衣服文件名": name,
-                    "获得票数": state.votes.get(name, 0)
-                })
-            df = pd.DataFrame(data)
-            csv = df.to_csv(index=False).encode('utf-8-sig')
-            st.download_button("📥 下载结果 CSV", csv, "results.csv", "text/csv")
+            # 直接用 csv 模块逐行写出，无需先构建 DataFrame
+            votes = state.get_votes()
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(["衣服文件名", "获得票数"])
+            writer.writerows(
+                (name, votes.get(name, 0))
+                for name in current_images
+            )
+            csv_bytes = buf.getvalue().encode('utf-8-sig')
+            st.download_button("📥 下载结果 CSV", csv_bytes, "results.csv", "text/csv")
             
         with st.expander("危险操作"):
             if st.button("清空投票数据"):
-                with state.lock:
-                    state.votes = {}
-                    state.voters = []
-                    # 重新初始化现有图片的票数
-                    for img_path in current_images:
-                        name = os.path.basename(img_path)
-                        state.votes[name] = 0
+                state.reset(current_images)
                 st.rerun()
 
 # --- 主界面 ---
@@ -156,60 +270,79 @@ if not current_images:
     if not admin_mode:
         st.stop()
 
-# 身份输入
-if not admin_mode:
-    st.write("👇 请勾选你喜欢的衣服，然后点击底部的提交按钮。")
-    voter_name = st.text_input("请输入你的名字", placeholder="例如：Alex")
+@st.fragment
+def vote_grid(state, current_images, admin_mode):
+    """
+    ⚡️ 投票区域单独作为一个 fragment：这里的交互只重跑本函数，
+    不会重新执行侧边栏统计和图片扫描
+    """
+    # 身份输入
+    if not admin_mode:
+        st.write("👇 请勾选你喜欢的衣服，然后点击底部的提交按钮。")
+        voter_name = st.text_input("请输入你的名字", placeholder="例如：Alex")
 
-# 投票表单
-if not admin_mode:
-    content_container = st.form("vote_form")
-else:
-    content_container = st.container()
+    # 投票表单
+    if not admin_mode:
+        content_container = st.form("vote_form")
+    else:
+        content_container = st.container()
+
+    # 预先整理好每张图片的 (序号, 文件名, 路径, 勾选框文字, 勾选框 key, 票数)，渲染时不再逐个查询/拼接
+    votes = state.get_votes()
+    key_prefix = f"check_{uid}_"
+    items = [
+        (idx, name, img["path"], img["label"], key_prefix + name, votes.get(name, 0))
+        for idx, (name, img) in enumerate(current_images.items())
+    ]
 
-with content_container:
-    cols = st.columns(3) # 默认3列
-    selected_imgs = []
+    with content_container:
+        selected_imgs = []
     
-    for idx, img_path in enumerate(current_images):
-        col = cols[idx % 3]
-        file_name = os.path.basename(img_path)
+        if admin_mode:
+            # ⚡️ 管理员只看图和票数：一次 st.image 调用显示全部图片
+            if items:
+                try:
+                    st.image(
+                        [path for _, _, path, _, _, _ in items],
+                        caption=[f"{name}｜票数: {count}" for _, name, _, _, _, count in items],
+                        width=250,
+                    )
+                except Exception as e:
+                    st.error("图片加载错")
+        else:
+            cols = st.columns(3) # 默认3列
         
-        with col:
-            try:
-                image = Image.open(img_path)
-                st.image(image, use_column_width=True)
-                
-                current_count = state.votes.get(file_name, 0)
-                
-                if admin_mode:
-                    st.info(f"票数: {current_count}")
-                else:
-                    st.caption(f"当前票数: {current_count}")
-                
-                if not admin_mode:
-                    if st.checkbox(f"喜欢这件 (#{idx+1})", key=file_name):
-                        selected_imgs.append(file_name)
-            except Exception as e:
-                st.error("图片加载错")
+            for idx, file_name, img_path, label, key, current_count in items:
+                with cols[idx % 3]:
+                    try:
+                        # ⚡️ 直接传文件路径，由 Streamlit 读取文件发送给浏览器，不再经过 PIL 解码/重新编码
+                        st.image(img_path, use_container_width=True)
+                        st.caption(f"当前票数: {current_count}")
+                    
+                        if st.checkbox(label, key=key):
+                            selected_imgs.append(file_name)
+                    except Exception as e:
+                        st.error("图片加载错")
 
-    if not admin_mode:
-        st.write("---")
-        submitted = st.form_submit_button("✅ 提交我的选择", type="primary")
+        if not admin_mode:
+            st.write("---")
+            submitted = st.form_submit_button("✅ 提交我的选择", type="primary")
         
-        if submitted:
-            if not voter_name:
-                st.error("❌ 请先输入名字！")
-            elif not selected_imgs:
-                st.warning("请至少选择一件衣服")
-            else:
-                # 调用安全的投票函数
-                success, msg = state.cast_vote(voter_name, selected_imgs)
-                if success:
-                    st.balloons()
-                    st.success(msg)
-                    import time
-                    time.sleep(1)
-                    st.rerun()
+            if submitted:
+                if not voter_name:
+                    st.error("❌ 请先输入名字！")
+                elif not selected_imgs:
+                    st.warning("请至少选择一件衣服")
                 else:
-                    st.warning(msg)
\ No newline at end of file
+                    # 调用安全的投票函数
+                    success, msg = state.cast_vote(voter_name, selected_imgs)
+                    if success:
+                        st.balloons()
+                        st.success(msg)
+                        import time
+                        time.sleep(1)
+                        st.rerun()
+                    else:
+                        st.warning(msg)
+
+vote_grid(state, current_images, admin_mode)